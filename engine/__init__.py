@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+from . core import RUN, CHECK, WORKITEM_STATES, Workitem, Transition, NewWorkitem, Engine, fair_share
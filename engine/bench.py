@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Times the engine without a database, from the module directory:
+
+    python -m engine.bench [workitems]
+"""
+
+from . core import Workitem, Transition, Engine
+
+import json
+import sys
+import time
+
+
+def bench(count=100000):
+    transitions = {
+        1: [Transition(1, 1, 2), Transition(2, 1, 3, condition="metadata['value'] % 2")],
+        2: [Transition(3, 2, 4, condition="metadata['value'] > 10")],
+    }
+    items = [Workitem(i, 1 + i % 3, state='done', job_metadata=json.dumps({'value': i})) for i in range(count)]
+    engine = Engine(lambda condition, item: eval(condition, {'__builtins__': {}}, {'metadata': item.metadata}))
+
+    start = time.time()
+    steps = [engine.next_step(item) for item in items]
+    spawned, completed = engine.plan_transitions(items, transitions)
+    elapsed = time.time() - start
+    print('%d workitems, %d steps, %d new workitems, %d completed in %.3fs (%.1f us/workitem)' % (
+        count, len(steps), len(spawned), sum(len(ids) for ids in completed.values()), elapsed,
+        elapsed * 1e6 / count))
+
+    running = [Workitem(i, 1, state='running', job_metadata=json.dumps({'value': i})) for i in range(count)]
+    start = time.time()
+    for item in running:
+        values = item.job_values()
+        values.update({'run': True, 'pid': item.id})
+        engine.apply_result(item, engine.next_step(item), values)
+    elapsed = time.time() - start
+    print('%d job results merged in %.3fs (%.1f us/workitem), %d changed' % (
+        count, elapsed, elapsed * 1e6 / count, sum(1 for item in running if item.changed())))
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Workflow engine core
+
+Plain python state machine of the workitems, without any Odoo import, so it
+can be run and timed on its own (see bench.py). The models load the state in
+bulk into these objects and persist the outcome through the EngineAdapter of
+models/engine_adapter.py.
+"""
+
+import json
+
+RUN = 'run'
+CHECK = 'check'
+
+# Conditions that don't need an evaluator
+CONSTANT_CONDITIONS = {
+    'True': True,
+    'False': False,
+    '1': True,
+    '0': False,
+}
+
+
+# States a job backend can move a workitem to
+WORKITEM_STATES = ('todo', 'running', 'cancelled', 'exception', 'done')
+
+
+class Workitem(object):
+    """Compact state of a work.workflow.workitem
+
+    The job backends get the values of job_values() and the engine merges
+    what they return back into the slots, *loaded* keeps the (state, run) read
+    from the database to know what changed.
+    """
+    __slots__ = ('id', 'action_id', 'job_type', 'instance_id', 'workflow_id', 'runner_host', 'state', 'run',
+                 'triggered', 'priority', 'job_target', 'job_metadata', 'parent_id', 'scheduled_run', 'pid',
+                 'error_msg', 'cache_ttl', 'cache_key', 'completed', 'loaded', '_metadata')
+
+    def __init__(self, id, action_id, job_type=False, instance_id=False, workflow_id=False, runner_host=False,
+                 state='todo', run=False, triggered=False, priority=False, job_target=False, job_metadata='{}',
+                 parent_id=False, scheduled_run=False, pid=0, error_msg='', cache_ttl=0, cache_key=False,
+                 completed=()):
+        self.id = id
+        self.action_id = action_id
+        self.job_type = job_type
+        self.instance_id = instance_id
+        self.workflow_id = workflow_id
+        self.runner_host = runner_host
+        self.state = state
+        self.run = run
+        self.triggered = triggered
+        self.priority = priority
+        self.job_target = job_target
+        self.job_metadata = job_metadata
+        self.parent_id = parent_id
+        self.scheduled_run = scheduled_run
+        self.pid = pid or 0
+        self.error_msg = error_msg or ''
+        self.cache_ttl = cache_ttl or 0
+        self.cache_key = cache_key
+        self.completed = set(completed)
+        self.loaded = (state, run)
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        """ Job metadata parsed on first use"""
+        if self._metadata is None:
+            self._metadata = json.loads(self.job_metadata or '{}')
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
+        self.job_metadata = json.dumps(metadata)
+
+    def job_values(self):
+        """ Values handed to run_job() and check_job() of the job backend"""
+        return {
+            'id': self.id,
+            'action_id': self.action_id,
+            'instance_id': self.instance_id,
+            'workflow_id': self.workflow_id,
+            'job_metadata': self.metadata,
+            'scheduled_run': self.scheduled_run,
+            'run': self.run,
+            'pid': self.pid,
+            'state': self.state,
+            'error_msg': self.error_msg,
+        }
+
+    def changed(self):
+        """ True if the state or the run flag moved since the workitem was loaded"""
+        return (self.state, self.run) != self.loaded
+
+
+class Transition(object):
+    """Compact state of a work.workflow.transition"""
+    __slots__ = ('id', 'action_from_id', 'action_to_id', 'condition', 'trigger', 'interval_nbr', 'interval_type')
+
+    def __init__(self, id, action_from_id, action_to_id, condition='True', trigger='auto', interval_nbr=1,
+                 interval_type='days'):
+        self.id = id
+        self.action_from_id = action_from_id
+        self.action_to_id = action_to_id
+        self.condition = condition
+        self.trigger = trigger
+        self.interval_nbr = interval_nbr
+        self.interval_type = interval_type
+
+
+class NewWorkitem(object):
+    """Workitem to create once a transition fired"""
+    __slots__ = ('source', 'transition')
+
+    def __init__(self, source, transition):
+        self.source = source
+        self.transition = transition
+
+
+def fair_share(budget, demands, weights):
+    """ Weighted max-min fair split of *budget* between queues
+
+    Every queue gets a share proportional to its weight, what a queue cannot use
+    (fewer pending items than its share) is split again between the others.
+
+    :param int budget: number of items to hand out
+    :param dict demands: queue key -> number of pending items
+    :param dict weights: queue key -> positive weight
+    :return: dict queue key -> number of items granted
+    """
+    allocation = dict.fromkeys(demands, 0)
+    active = set(key for key, demand in demands.items() if demand > 0)
+    remaining = budget
+    while remaining > 0 and active:
+        total_weight = float(sum(weights[key] for key in active))
+        granted = 0
+        for key in sorted(active, key=lambda k: (-weights[k], k)):
+            share = max(1, int(remaining * weights[key] / total_weight))
+            share = min(share, demands[key] - allocation[key], remaining - granted)
+            allocation[key] += share
+            granted += share
+            if granted >= remaining:
+                break
+        remaining -= granted
+        active = set(key for key in active if allocation[key] < demands[key])
+    return allocation
+
+
+class Engine(object):
+    """Decides what happens to the workitems, the caller runs the jobs and
+    persists the result.
+
+    :param evaluate: callable(condition, workitem) returning the value of a
+                     transition condition for the workitem
+    """
+
+    def __init__(self, evaluate):
+        self.evaluate = evaluate
+
+    @staticmethod
+    def next_step(item, now=None):
+        """ What the manager has to do with the workitem on this tick
+
+        :param now: current server datetime string, jobs scheduled later are not run yet
+        :return: RUN to launch the job, CHECK to poll it or None
+        """
+        if item.state != 'running':
+            return None
+        if item.run:
+            return CHECK
+        if now and item.scheduled_run and item.scheduled_run > now:
+            return None
+        return RUN
+
+    @staticmethod
+    def apply_result(item, step, result):
+        """ Merge the values returned by the job backend into the workitem
+
+        :param step: RUN or CHECK
+        :param dict result: values returned by run_job() or check_job()
+        """
+        if isinstance(result.get('job_metadata'), dict):
+            item.metadata = result['job_metadata']
+        if step == RUN:
+            item.run = bool(result.get('run', item.run))
+        if result.get('state') in WORKITEM_STATES:
+            item.state = result['state']
+        item.pid = result.get('pid') or item.pid
+        item.error_msg = result.get('error_msg', item.error_msg) or ''
+
+    @staticmethod
+    def apply_cached(item, cached):
+        """ Complete a workitem with the *this_job* values of a cached run"""
+        metadata = item.metadata
+        metadata.setdefault('this_job', {}).update(cached)
+        item.metadata = metadata
+        item.run = True
+        item.state = 'done'
+
+    def condition_holds(self, condition, item):
+        condition = (condition or 'True').strip()
+        if condition in CONSTANT_CONDITIONS:
+            return CONSTANT_CONDITIONS[condition]
+        return bool(self.evaluate(condition, item))
+
+    def plan_transitions(self, items, transitions):
+        """ Fire the pending transitions of done workitems
+
+        Every pending transition is completed, the ones whose condition holds
+        create a workitem for their destination action. The workitems are
+        marked as triggered. Children of a map workitem don't fire anything,
+        the flow goes on from the map workitem once all of them are done.
+
+        :param items: done and not triggered Workitem
+        :param dict transitions: action id -> list of outgoing Transition
+        :return: (list of NewWorkitem, dict workitem id -> completed transition ids)
+        """
+        spawned = []
+        completed = {}
+        for item in items:
+            if item.parent_id:
+                completed[item.id] = []
+                item.triggered = True
+                continue
+            pending = [transition for transition in transitions.get(item.action_id, ())
+                       if transition.id not in item.completed]
+            for transition in pending:
+                if self.condition_holds(transition.condition, item):
+                    spawned.append(NewWorkitem(item, transition))
+            completed[item.id] = [transition.id for transition in pending]
+            item.completed.update(completed[item.id])
+            item.triggered = True
+        return spawned, completed
+
+    @staticmethod
+    def instances_to_close(pending):
+        """ Running instances are done once all their workitems are done
+
+        :param dict pending: running instance id -> number of workitems not done
+        :return: list of instance ids
+        """
+        return [instance_id for instance_id, count in pending.items() if not count]
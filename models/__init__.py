@@ -3,3 +3,7 @@ from . import workflow
 from . import instances
 from . import jobs
 from . import task_runner
+from . import profiling
+from . import analytics
+from . import limits
+from . import cache
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, _, tools
+from odoo.exceptions import UserError
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+import bisect
+import json
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the run to done duration histogram, the last
+# histogram slot counts everything above the last bound
+DURATION_BOUNDS = [1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400]
+
+# Counter of each event, 'started' is the job launch (run set), the others the new state
+STATE_COUNTERS = {
+    'started': 'started_count',
+    'done': 'done_count',
+    'exception': 'exception_count',
+    'cancelled': 'cancelled_count',
+}
+
+
+# Values of get_summary() shown by work.workflow.stats.summary
+SUMMARY_FIELDS = ['workflow_id', 'action_id', 'started_count', 'done_count', 'exception_count', 'cancelled_count',
+                  'throughput', 'success_rate', 'duration_avg', 'duration_p50', 'duration_p95', 'duration_max']
+
+
+def duration_percentile(histogram, percentile, duration_max=0.0):
+    """ Estimate a percentile from a duration histogram
+
+    :param list histogram: counts per DURATION_BOUNDS slot (+1 overflow slot)
+    :param percentile: 0-100
+    :param duration_max: returned when the percentile falls in the overflow slot
+    :return: upper bound of the slot holding the percentile
+    """
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    rank = total * percentile / 100.0
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if count and seen >= rank:
+            if index < len(DURATION_BOUNDS):
+                return float(min(DURATION_BOUNDS[index], duration_max or DURATION_BOUNDS[index]))
+            return float(duration_max)
+    return float(duration_max)
+
+
+class WorkflowStats(models.Model):
+    """Hourly summary of workitem activity per workflow and action
+
+    Every batch of state changes appends a delta row to the hour bucket
+    instead of updating a shared row, so concurrent managers never wait on
+    each other. rollup() merges the delta rows of the past hours into one
+    row per workflow, action and hour. The analytics never need to scan
+    work.workflow.workitem.
+    """
+    _name = 'work.workflow.stats'
+    _description = "Workflow Analytics"
+    _order = 'bucket desc, workflow_id, action_id'
+    _rec_name = 'bucket'
+
+    bucket = fields.Datetime('Hour', required=True, readonly=True, index=True)
+    age = fields.Integer('Age (hours)', compute='_compute_age', search='_search_age')
+    workflow_id = fields.Many2one('work.workflow', 'Workflow', required=True, readonly=True, ondelete='cascade',
+                                  index=True)
+    action_id = fields.Many2one('work.workflow.action', 'Action', required=True, readonly=True, ondelete='cascade')
+    started_count = fields.Integer('Started', readonly=True)
+    done_count = fields.Integer('Done', readonly=True)
+    exception_count = fields.Integer('Exceptions', readonly=True)
+    cancelled_count = fields.Integer('Cancelled', readonly=True)
+    duration_sum = fields.Float('Total Duration (s)', readonly=True)
+    duration_max = fields.Float('Max Duration (s)', readonly=True, group_operator='max')
+    duration_histogram = fields.Text('Duration Histogram', readonly=True, default='[]')
+    success_rate = fields.Float('Success Rate (%)', compute='_compute_durations')
+    duration_avg = fields.Float('Avg Duration (s)', compute='_compute_durations')
+    duration_p50 = fields.Float('p50 Duration (s)', compute='_compute_durations')
+    duration_p95 = fields.Float('p95 Duration (s)', compute='_compute_durations')
+
+    @api.multi
+    def _compute_age(self):
+        now = datetime.now()
+        for stats in self:
+            stats.age = int((now - fields.Datetime.from_string(stats.bucket)).total_seconds() // 3600)
+
+    def _search_age(self, operator, value):
+        # age < 24 is a bucket later than 24 hours ago
+        operators = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '=': '='}
+        if operator not in operators:
+            raise UserError(_('Unsupported operator %s on the analytics age') % operator)
+        limit = datetime.now() - timedelta(hours=value)
+        return [('bucket', operators[operator], fields.Datetime.to_string(limit))]
+
+    @api.multi
+    def _compute_durations(self):
+        for stats in self:
+            finished = stats.done_count + stats.exception_count + stats.cancelled_count
+            histogram = json.loads(stats.duration_histogram or '[]')
+            stats.success_rate = finished and 100.0 * stats.done_count / finished or 0.0
+            stats.duration_avg = stats.done_count and stats.duration_sum / stats.done_count or 0.0
+            stats.duration_p50 = duration_percentile(histogram, 50, stats.duration_max)
+            stats.duration_p95 = duration_percentile(histogram, 95, stats.duration_max)
+
+    @api.model
+    def record_state_change(self, workitems, state):
+        """ Append the workitems that just moved to *state* to the current hour bucket,
+        one delta row per workflow and action
+
+        :param workitems: work.workflow.workitem records
+        :param state: new workitem state, or 'started' when their job was launched
+        """
+        counter = STATE_COUNTERS.get(state)
+        if not counter:
+            return
+        now = datetime.now()
+        bucket = now.strftime('%Y-%m-%d %H:00:00')
+        grouped = defaultdict(list)
+        for item in workitems:
+            if item.workflow_id and item.action_id:
+                grouped[(item.workflow_id.id, item.action_id.id)].append(item)
+
+        for (workflow_id, action_id), items in grouped.items():
+            values = {
+                'bucket': bucket,
+                'workflow_id': workflow_id,
+                'action_id': action_id,
+                counter: len(items),
+            }
+            if state == 'done':
+                histogram = [0] * (len(DURATION_BOUNDS) + 1)
+                durations = []
+                for item in items:
+                    date_run = item.date_run or item.create_date
+                    duration = (now - fields.Datetime.from_string(date_run)).total_seconds() if date_run else 0.0
+                    histogram[bisect.bisect_left(DURATION_BOUNDS, duration)] += 1
+                    durations.append(duration)
+                values.update({
+                    'duration_histogram': json.dumps(histogram),
+                    'duration_sum': sum(durations),
+                    'duration_max': max(durations),
+                })
+            self.sudo().create(values)
+
+    @api.multi
+    def _merge(self):
+        """ Totals of the rows
+
+        :return: dict with the counters, duration sum and max and the merged histogram list
+        """
+        totals = dict.fromkeys(STATE_COUNTERS.values(), 0)
+        totals.update({
+            'duration_sum': 0.0,
+            'duration_max': 0.0,
+            'histogram': [0] * (len(DURATION_BOUNDS) + 1),
+        })
+        for stats in self:
+            for counter in STATE_COUNTERS.values():
+                totals[counter] += stats[counter]
+            totals['duration_sum'] += stats.duration_sum
+            totals['duration_max'] = max(totals['duration_max'], stats.duration_max)
+            for index, count in enumerate(json.loads(stats.duration_histogram or '[]')):
+                totals['histogram'][index] += count
+        return totals
+
+    @api.model
+    def rollup(self):
+        """ Merge the delta rows of the past hours into one row per workflow, action and hour,
+        the current hour is left alone as it still gets new rows
+        """
+        current = datetime.now().strftime('%Y-%m-%d %H:00:00')
+        self.env.cr.execute("""SELECT array_agg(id ORDER BY id) FROM work_workflow_stats
+                               WHERE bucket < %s
+                               GROUP BY workflow_id, action_id, bucket
+                               HAVING count(*) > 1""", (current,))
+        for ids, in self.env.cr.fetchall():
+            rows = self.sudo().browse(ids)
+            totals = rows._merge()
+            totals['duration_histogram'] = json.dumps(totals.pop('histogram'))
+            rows[0].write(totals)
+            (rows - rows[0]).unlink()
+        return True
+
+    @api.model
+    def get_summary(self, date_from, date_to, domain=None):
+        """ Merge the hourly buckets between *date_from* and *date_to* per workflow and action
+
+        :param date_from: start datetime string, included
+        :param date_to: end datetime string, excluded
+        :param domain: extra search domain on work.workflow.stats
+        :return: list of dicts with throughput (done per hour of the range), success rate
+                 and p50/p95 durations
+        """
+        hours = (fields.Datetime.from_string(date_to) - fields.Datetime.from_string(date_from)).total_seconds() / 3600
+        grouped = defaultdict(lambda: self.browse())
+        for stats in self.search([('bucket', '>=', date_from), ('bucket', '<', date_to)] + (domain or [])):
+            grouped[(stats.workflow_id.id, stats.action_id.id)] |= stats
+
+        result = []
+        for (workflow_id, action_id), rows in grouped.items():
+            line = rows._merge()
+            histogram = line.pop('histogram')
+            finished = line['done_count'] + line['exception_count'] + line['cancelled_count']
+            line.update({
+                'workflow_id': workflow_id,
+                'action_id': action_id,
+                'throughput': hours > 0 and line['done_count'] / hours or 0.0,
+                'success_rate': finished and 100.0 * line['done_count'] / finished or 0.0,
+                'duration_avg': line['done_count'] and line['duration_sum'] / line['done_count'] or 0.0,
+                'duration_p50': duration_percentile(histogram, 50, line['duration_max']),
+                'duration_p95': duration_percentile(histogram, 95, line['duration_max']),
+            })
+            result.append(line)
+        return result
+
+
+class WorkflowStatsSummary(models.TransientModel):
+    """Dashboard of get_summary(): throughput, success rate and percentiles per
+    workflow and action over a date range, recomputed when the range changes
+    """
+    _name = 'work.workflow.stats.summary'
+    _description = "Workflow Analytics Summary"
+
+    date_from = fields.Datetime('From', required=True,
+                                default=lambda self: fields.Datetime.to_string(datetime.now() - timedelta(days=1)))
+    date_to = fields.Datetime('To', required=True, default=fields.Datetime.now)
+    workflow_id = fields.Many2one('work.workflow', 'Workflow')
+    line_ids = fields.One2many('work.workflow.stats.summary.line', 'summary_id', 'Lines', readonly=True)
+
+    @api.onchange('date_from', 'date_to', 'workflow_id')
+    def _onchange_range(self):
+        if not self.date_from or not self.date_to:
+            return
+        domain = [('workflow_id', '=', self.workflow_id.id)] if self.workflow_id else []
+        lines = self.env['work.workflow.stats'].get_summary(self.date_from, self.date_to, domain)
+        self.line_ids = [(5,)] + [(0, 0, dict((name, line[name]) for name in SUMMARY_FIELDS)) for line in lines]
+
+
+class WorkflowStatsSummaryLine(models.TransientModel):
+    _name = 'work.workflow.stats.summary.line'
+    _description = "Workflow Analytics Summary Line"
+    _order = 'workflow_id, action_id'
+
+    summary_id = fields.Many2one('work.workflow.stats.summary', 'Summary', required=True, ondelete='cascade')
+    workflow_id = fields.Many2one('work.workflow', 'Workflow', readonly=True)
+    action_id = fields.Many2one('work.workflow.action', 'Action', readonly=True)
+    started_count = fields.Integer('Started', readonly=True)
+    done_count = fields.Integer('Done', readonly=True)
+    exception_count = fields.Integer('Exceptions', readonly=True)
+    cancelled_count = fields.Integer('Cancelled', readonly=True)
+    throughput = fields.Float('Throughput (done/h)', readonly=True)
+    success_rate = fields.Float('Success Rate (%)', readonly=True)
+    duration_avg = fields.Float('Avg Duration (s)', readonly=True)
+    duration_p50 = fields.Float('p50 Duration (s)', readonly=True)
+    duration_p95 = fields.Float('p95 Duration (s)', readonly=True)
+    duration_max = fields.Float('Max Duration (s)', readonly=True)
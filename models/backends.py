@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from odoo import _
+from odoo.exceptions import UserError
+
+from collections import OrderedDict
+import importlib
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+# Other addons can publish job types without importing them:
+#   entry_points={'odoo.addons.work.job_types': [
+#       'work.workflow.job.ftp = odoo.addons.my_addon']}
+# The entry point is only read, never loaded: importing an addon outside of the
+# Odoo module loading breaks its models. The job type is labelled after its model
+# until the addon registers its own label with register_job_type() once loaded.
+ENTRY_POINT_GROUP = 'odoo.addons.work.job_types'
+
+_job_types = OrderedDict()
+_entry_points_loaded = []
+
+
+def register_job_type(model, label):
+    """ Register a job type, the model must inherit work.workflow.job and its
+    name should start with *work.workflow.job.* to be picked by the manager.
+    Client libraries of the job should be imported with lazy_import().
+
+    :param model: job model name, stored in work.workflow.action.job_type
+    :param label: name shown to the user
+    """
+    _job_types[model] = label
+
+
+def _default_label(model):
+    return model.split('.')[-1].replace('_', ' ').title()
+
+
+def _load_entry_points():
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded.append(True)
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP):
+        _job_types.setdefault(entry_point.name, _default_label(entry_point.name))
+
+
+def get_job_types():
+    """ All the registered job types
+
+    :return: list of (model, label)
+    """
+    _load_entry_points()
+    return _job_types.items()
+
+
+class LazyModule(object):
+    """Stand-in for a client library, the module is only imported on first
+    attribute access so workers that never run the job don't pay for it
+    and a missing library only breaks the job that needs it.
+    """
+
+    def __init__(self, name, package=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_package'] = package or name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            try:
+                module = importlib.import_module(self._name)
+            except ImportError:
+                raise UserError(_("The python package %s is required to run this job.") % self._package)
+            self.__dict__['_module'] = module
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+def lazy_import(name, package=None):
+    """ Import *name* the first time it is used
+
+    :param name: module name
+    :param package: pip package, shown when the module is missing
+    :return: LazyModule
+    """
+    return LazyModule(name, package)
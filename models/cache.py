@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, _, tools
+
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import psycopg2
+
+
+_logger = logging.getLogger(__name__)
+
+
+def cache_key(key_data):
+    """ Stable hash of the json serializable *key_data*
+
+    :return: hex digest
+    """
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True)).hexdigest()
+
+
+class WorkflowJobCache(models.Model):
+    """Results of cacheable jobs, keyed by action and a hash of the relevant
+    job metadata (see get_cache_key() on work.workflow.job)
+    """
+    _name = 'work.workflow.job.cache'
+    _description = "Workflow Job Cache"
+    _order = 'last_hit desc, id desc'
+    _rec_name = 'key'
+
+    action_id = fields.Many2one('work.workflow.action', 'Action', required=True, readonly=True, ondelete='cascade',
+                                index=True)
+    key = fields.Char('Key', required=True, readonly=True)
+    result = fields.Text('Result', readonly=True, default='{}')
+    expire_date = fields.Datetime('Expires', required=True, readonly=True)
+    last_hit = fields.Datetime('Last Hit', readonly=True)
+    hit_count = fields.Integer('Hits', readonly=True)
+
+    _sql_constraints = [
+        ('action_key_unique', 'UNIQUE(action_id, key)', 'One cached result per action and key')
+    ]
+
+    @api.model
+    def lookup(self, action, key):
+        """ Cached result of the action for *key*
+
+        :param action: work.workflow.action record
+        :param key: hash returned by cache_key()
+        :return: dict with the *this_job* values of the cached run or None
+        """
+        entry = self.sudo().search([
+            ('action_id', '=', action.id),
+            ('key', '=', key),
+            ('expire_date', '>', fields.Datetime.now()),
+        ], limit=1)
+        if not entry:
+            return None
+        entry.write({'hit_count': entry.hit_count + 1, 'last_hit': fields.Datetime.now()})
+        return json.loads(entry.result)
+
+    @api.model
+    def store(self, action, key, result):
+        """ Cache the *this_job* values of a finished run for the action TTL, then evict
+        the expired entries and the least recently used ones above the action cache size
+
+        :param action: work.workflow.action record
+        :param key: hash returned by cache_key()
+        :param dict result: *this_job* values of the done workitem
+        """
+        now = datetime.now()
+        values = {
+            'result': json.dumps(result),
+            'expire_date': fields.Datetime.to_string(now + timedelta(seconds=action.cache_ttl)),
+            'last_hit': fields.Datetime.to_string(now),
+        }
+        entry = self.sudo().search([('action_id', '=', action.id), ('key', '=', key)], limit=1)
+        if entry:
+            entry.write(values)
+        else:
+            values.update({'action_id': action.id, 'key': key})
+            try:
+                with self.env.cr.savepoint():
+                    self.sudo().create(values)
+            except psycopg2.IntegrityError:
+                # Stored by another manager in the meantime
+                _logger.debug('WKF: Result of action %s already cached', action.id)
+
+        self.env.cr.execute("""DELETE FROM work_workflow_job_cache
+                               WHERE action_id = %s AND (expire_date <= %s OR id NOT IN (
+                                   SELECT id FROM work_workflow_job_cache WHERE action_id = %s
+                                   ORDER BY last_hit DESC NULLS LAST, id DESC LIMIT %s))""",
+                            (action.id, fields.Datetime.to_string(now), action.id, max(action.cache_size, 1)))
+        self.invalidate_cache()
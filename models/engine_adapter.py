@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields, tools
+from odoo.tools.safe_eval import safe_eval
+
+from .. engine import RUN, CHECK, Workitem, Transition, Engine, fair_share
+from . cache import cache_key
+from . profiling import NullProfiler
+from . workflow import WORK_PRIORITY_WEIGHTS, DEFAULT_PRIORITY
+
+from collections import OrderedDict, defaultdict
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+# Columns of Workitem, in the order of its constructor
+WORKITEM_COLUMNS = """w.id, w.action_id, a.job_type, w.instance_id, w.workflow_id, w.runner_host, w.state, w.run,
+                      w.triggered, w.priority, w.job_target, w.job_metadata, w.parent_id,
+                      to_char(w.scheduled_run, 'YYYY-MM-DD HH24:MI:SS'), w.pid, w.error_msg, a.cache_ttl,
+                      w.cache_key"""
+
+# Running workitems the manager can run or check now, this client might not be
+# capable of doing all type of jobs, this is why we need a selector
+PENDING_WHERE = """w.state = 'running' AND a.job_type LIKE %s
+                   AND (w.run OR w.scheduled_run IS NULL OR w.scheduled_run <= (now() at time zone 'UTC'))"""
+JOB_TYPE_SELECTOR = 'work.workflow.job.%'
+
+# Workitems the job limits don't apply to: launched ones are only checked and
+# cacheable ones may be completed from the cache without launching anything
+UNLIMITED_SQL = "(w.run OR COALESCE(a.cache_ttl, 0) > 0)"
+
+# Columns of EngineAdapter._pending_query()
+PENDING_COLUMNS = "p.id, p.workflow_id, p.priority, p.scheduled_run, p.job_type, p.job_target, p.unlimited"
+
+
+class EngineAdapter(object):
+    """Feeds the engine from the workflow models and persists its decisions
+
+    State is read with one query per batch, the job backends work on plain
+    values and the results are written back with one UPDATE per chunk, so the
+    manager loop does not go through the ORM for every workitem.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.engine = Engine(self.evaluate)
+
+    def evaluate(self, condition, item):
+        """ Transition conditions see the job metadata and the workitem record"""
+        return safe_eval(condition, {
+            'metadata': item.metadata,
+            'workitem': self.env['work.workflow.workitem'].browse(item.id),
+        })
+
+    def load_workitems(self, workitem_ids, completed=False):
+        """ Engine workitems in the order of *workitem_ids*
+
+        :param list workitem_ids: work.workflow.workitem ids
+        :param completed: also load the completed transitions
+        :return: list of Workitem
+        """
+        if not workitem_ids:
+            return []
+        cr = self.env.cr
+        cr.execute("""SELECT %s
+                      FROM work_workflow_workitem w
+                      LEFT JOIN work_workflow_action a ON a.id = w.action_id
+                      WHERE w.id IN %%s""" % WORKITEM_COLUMNS, (tuple(workitem_ids),))
+        items = dict((row[0], Workitem(*row)) for row in cr.fetchall())
+        if completed and items:
+            # completed_ids is declared with swapped column names: transition_id holds the workitem
+            cr.execute("""SELECT transition_id, workitem_id FROM completed_transitions_rel
+                          WHERE transition_id IN %s""", (tuple(items),))
+            for workitem_id, transition_id in cr.fetchall():
+                items[workitem_id].completed.add(transition_id)
+        return [items[workitem_id] for workitem_id in workitem_ids if workitem_id in items]
+
+    def schedule(self, budget, limiter=None):
+        """ Running workitems to run or check on this tick
+
+        Pending workitems are queued per (workflow, priority) and the budget is
+        split between the queues by fair_share() with the workflow weight times
+        the priority weight, so a workflow with a huge backlog cannot starve the
+        others and urgent workitems get a larger share. The queues are counted
+        with one query and their heads loaded with another.
+
+        Workitems to launch of a limited job type are ranked across all the
+        queues, most urgent first, and only the ones within the capacity of
+        their target and then of their job type are queued, so a limited job
+        type does not take a share of the budget it cannot use. Saturated ones
+        are not loaded at all, only their launched workitems are checked.
+
+        :param budget: max number of workitems, 0 for no limit
+        :param limiter: JobLimiter of the tick, None for no limit
+        :return: list of Workitem, most urgent first
+        """
+        cr = self.env.cr
+        pending, params = self._pending_query(limiter)
+
+        cr.execute("""SELECT p.workflow_id, p.priority, count(*), COALESCE(max(f.weight), 1)
+                      FROM (%s) p
+                      LEFT JOIN work_workflow f ON f.id = p.workflow_id
+                      GROUP BY p.workflow_id, p.priority""" % pending, params)
+        demands = {}
+        weights = {}
+        for workflow_id, priority, count, weight in cr.fetchall():
+            key = (workflow_id, priority)
+            demands[key] = count
+            weights[key] = max(weight, 1) * WORK_PRIORITY_WEIGHTS.get(priority or DEFAULT_PRIORITY, 1)
+        allocation = fair_share(budget, demands, weights) if budget else demands
+        queues = [key + (slots,) for key, slots in allocation.items() if slots]
+        if not queues:
+            return []
+
+        cr.execute("""SELECT %s
+                      FROM (SELECT p.id, p.workflow_id, p.priority,
+                                   row_number() OVER (PARTITION BY p.workflow_id, p.priority
+                                                      ORDER BY p.scheduled_run, p.id) AS queue_rank
+                            FROM (%s) p) r
+                      JOIN (VALUES %s) AS q(workflow_id, priority, slots)
+                          ON r.workflow_id IS NOT DISTINCT FROM q.workflow_id
+                          AND r.priority IS NOT DISTINCT FROM q.priority AND r.queue_rank <= q.slots
+                      JOIN work_workflow_workitem w ON w.id = r.id
+                      JOIN work_workflow_action a ON a.id = w.action_id
+                      ORDER BY w.priority DESC NULLS LAST, w.scheduled_run, w.id""" % (
+                       WORKITEM_COLUMNS, pending, ', '.join(['(%s::int, %s::varchar, %s::int)'] * len(queues))),
+                   params + [value for queue in queues for value in queue])
+        return [Workitem(*row) for row in cr.fetchall()]
+
+    def _pending_query(self, limiter=None):
+        """ Query of the workitems the tick can take, within the launch capacity of the limiter
+
+        :return: (query, params), the query selects the PENDING_COLUMNS of p
+        """
+        where = PENDING_WHERE
+        params = [JOB_TYPE_SELECTOR]
+        saturated = limiter.saturated() if limiter else []
+        job_types = tuple(job_type for job_type, target in saturated if not target)
+        targets = tuple((job_type, target) for job_type, target in saturated if target)
+        if job_types:
+            where += " AND (%s OR a.job_type NOT IN %%s)" % UNLIMITED_SQL
+            params.append(job_types)
+        if targets:
+            where += " AND (%s OR (a.job_type, w.job_target) NOT IN %%s OR w.job_target IS NULL)" % UNLIMITED_SQL
+            params.append(targets)
+        query = """SELECT w.id, w.workflow_id, w.priority, w.scheduled_run, a.job_type, w.job_target,
+                          %s AS unlimited
+                   FROM work_workflow_workitem w
+                   JOIN work_workflow_action a ON a.id = w.action_id
+                   WHERE %s""" % (UNLIMITED_SQL, where)
+
+        # Per target capacities first, then the job type ones over what is left of all the targets
+        caps = limiter.caps() if limiter else {}
+        for columns, limits in ((('job_type', 'job_target'), [key + (slots,) for key, slots in caps.items() if key[1]]),
+                                (('job_type',), [key[:1] + (slots,) for key, slots in caps.items() if not key[1]])):
+            if not limits:
+                continue
+            query = """SELECT %(columns)s
+                       FROM (SELECT %(columns)s,
+                                    row_number() OVER (PARTITION BY p.unlimited, %(partition)s
+                                                       ORDER BY p.priority DESC NULLS LAST, p.scheduled_run, p.id
+                                                       ) AS launch_rank
+                             FROM (%(query)s) p) p
+                       LEFT JOIN (VALUES %(values)s) AS c(%(names)s, slots)
+                           ON NOT p.unlimited AND %(match)s
+                       WHERE c.slots IS NULL OR p.launch_rank <= c.slots""" % {
+                'columns': PENDING_COLUMNS,
+                'partition': ', '.join('p.%s' % column for column in columns),
+                'query': query,
+                'values': ', '.join(['(%s)' % ', '.join(['%s::varchar'] * len(columns) + ['%s::int'])] * len(limits)),
+                'names': ', '.join(columns),
+                'match': ' AND '.join('c.%s = p.%s' % (column, column) for column in columns),
+            }
+            params += [value for limit in limits for value in limit]
+        return query, params
+
+    def process(self, items, limiter=None, profiler=None, debug=False, steps=(RUN, CHECK)):
+        """ Run or check the jobs of the workitems and persist the results
+
+        :param items: list of Workitem
+        :param limiter: JobLimiter deciding which jobs can be launched, None for no limit
+        :param profiler: TickProfiler timing the jobs per job type
+        :param debug: let the job exceptions through
+        :param steps: steps to take, the others are skipped
+        :return: list of the processed Workitem
+        """
+        profiler = profiler or NullProfiler()
+        now = fields.Datetime.now()
+        processed = []
+        for item in items:
+            step = self.engine.next_step(item, now)
+            if step not in steps:
+                continue
+            # Cacheable jobs already ran with the same inputs are completed with the
+            # cached result, before the limiter so they don't take a launch slot
+            if step == RUN and item.cache_ttl:
+                with profiler.phase('run_job', item.job_type):
+                    hit = self.cache_lookup(item)
+                if hit:
+                    processed.append(item)
+                    continue
+            if step == RUN and limiter and not limiter.acquire(item.job_type, item.job_target):
+                continue
+            with profiler.phase('%s_job' % step, item.job_type):
+                self._call_job(item, step, debug)
+            processed.append(item)
+        with profiler.phase('persist'):
+            self.persist(processed)
+        return processed
+
+    def _call_job(self, item, step, debug=False):
+        backend = self.env[item.job_type]
+        values = item.job_values()
+        try:
+            # A failing job must not abort the transaction of the whole tick
+            with self.env.cr.savepoint():
+                result = backend.run_job(values) if step == RUN else backend.check_job(values)
+        except Exception as e:
+            # Debug for development mode
+            if debug:
+                raise
+            _logger.exception('WKF: %s of workitem %s failed', step, item.id)
+            result = {'error_msg': tools.ustr(e)}
+        self.engine.apply_result(item, step, result or values)
+        # Jobs can finish in run_job() already
+        if item.state == 'done' and item.cache_key:
+            self.cache_store(item)
+
+    def _cache_key(self, item):
+        if not item.cache_ttl:
+            return False
+        key_data = self.env[item.job_type].get_cache_key(item.metadata)
+        if key_data is None:
+            return False
+        return cache_key(key_data)
+
+    def cache_lookup(self, item):
+        """ Complete the workitem from work.workflow.job.cache if its job already ran
+
+        :return: True on a cache hit
+        """
+        item.cache_key = self._cache_key(item)
+        if not item.cache_key:
+            return False
+        action = self.env['work.workflow.action'].browse(item.action_id)
+        cached = self.env['work.workflow.job.cache'].lookup(action, item.cache_key)
+        if cached is None:
+            return False
+        self.engine.apply_cached(item, cached)
+        return True
+
+    def cache_store(self, item):
+        action = self.env['work.workflow.action'].browse(item.action_id)
+        self.env['work.workflow.job.cache'].store(action, item.cache_key, item.metadata.get('this_job', {}))
+
+    def persist(self, items, chunk_size=1000):
+        """ Write the job results of the workitems back with one UPDATE ... FROM (VALUES ...)
+        per chunk, then notify the job launches and the state changes like write() does
+
+        :param items: processed Workitem
+        """
+        if not items:
+            return
+        cr = self.env.cr
+        now = fields.Datetime.now()
+        changed = defaultdict(list)
+        previous = {}
+        started = []
+        rows = []
+        for item in items:
+            loaded_state, loaded_run = item.loaded
+            rows.append((item.id, item.job_metadata, item.run, item.state, item.pid, item.error_msg,
+                         item.cache_key or None, now if item.run and not loaded_run else None,
+                         now if item.state == 'done' and loaded_state != 'done' else None))
+            if item.run and not loaded_run:
+                started.append(item.id)
+            if item.state != loaded_state:
+                changed[item.state].append(item.id)
+                previous[item.id] = loaded_state
+
+        query = """UPDATE work_workflow_workitem w
+                   SET job_metadata = v.job_metadata, run = v.run, state = v.state, pid = v.pid,
+                       error_msg = v.error_msg, cache_key = COALESCE(v.cache_key, w.cache_key),
+                       date_run = COALESCE(v.date_run, w.date_run), date_done = COALESCE(v.date_done, w.date_done),
+                       write_uid = %%s, write_date = (now() at time zone 'UTC')
+                   FROM (VALUES %s) AS v(id, job_metadata, run, state, pid, error_msg, cache_key, date_run, date_done)
+                   WHERE w.id = v.id"""
+        row_template = "(%s::int, %s::text, %s::bool, %s::varchar, %s::int, %s::text, %s::varchar, " \
+                       "%s::timestamp, %s::timestamp)"
+        for index in xrange(0, len(rows), chunk_size):
+            chunk = rows[index:index + chunk_size]
+            cr.execute(query % ', '.join([row_template] * len(chunk)),
+                       [self.env.uid] + [value for row in chunk for value in row])
+
+        Workitems = self.env['work.workflow.workitem']
+        Workitems.invalidate_cache(ids=[item.id for item in items])
+        if started:
+            self.env['work.workflow.stats'].record_state_change(Workitems.browse(started), 'started')
+        for state, workitem_ids in changed.items():
+            Workitems.browse(workitem_ids)._notify_state_change(state, previous)
+
+    def load_transitions(self, action_ids):
+        """ Outgoing transitions of the actions
+
+        :return: dict action id -> list of Transition
+        """
+        transitions = defaultdict(list)
+        if not action_ids:
+            return transitions
+        self.env.cr.execute("""SELECT id, action_from_id, action_to_id, condition, trigger, interval_nbr, interval_type
+                               FROM work_workflow_transition
+                               WHERE action_from_id IN %s ORDER BY id""", (tuple(action_ids),))
+        for row in self.env.cr.fetchall():
+            transition = Transition(*row)
+            transitions[transition.action_from_id].append(transition)
+        return transitions
+
+    def triggerable(self, limit=None):
+        """ Done workitems whose transitions have not fired yet, most urgent first
+
+        :param limit: max number of workitems, None for all
+        :return: OrderedDict job type -> list of work.workflow.workitem ids
+        """
+        self.env.cr.execute("""SELECT w.id, a.job_type
+                               FROM work_workflow_workitem w
+                               LEFT JOIN work_workflow_action a ON a.id = w.action_id
+                               WHERE w.state = 'done' AND NOT w.triggered
+                               ORDER BY w.priority DESC NULLS LAST, w.id
+                               LIMIT %s""", (limit,))
+        groups = OrderedDict()
+        for workitem_id, job_type in self.env.cr.fetchall():
+            groups.setdefault(job_type or False, []).append(workitem_id)
+        return groups
+
+    def run_transitions(self, workitem_ids):
+        """ Fire the transitions of done workitems and create the next workitems
+
+        :param list workitem_ids: done and not triggered work.workflow.workitem ids
+        :return: created work.workflow.workitem records
+        """
+        Workitems = self.env['work.workflow.workitem']
+        items = self.load_workitems(workitem_ids, completed=True)
+        if not items:
+            return Workitems
+        transitions = self.load_transitions(set(item.action_id for item in items))
+        spawned, completed = self.engine.plan_transitions(items, transitions)
+
+        rows = [(workitem_id, transition_id)
+                for workitem_id, transition_ids in completed.items() for transition_id in transition_ids]
+        if rows:
+            self.env.cr.execute("INSERT INTO completed_transitions_rel (transition_id, workitem_id) VALUES %s" %
+                                ', '.join(['(%s, %s)'] * len(rows)), [value for row in rows for value in row])
+            Workitems.invalidate_cache(['completed_ids'])
+        Workitems.browse([item.id for item in items]).write({'triggered': True})
+
+        return Workitems._create_bulk([{
+            'action_id': new.transition.action_to_id,
+            'instance_id': new.source.instance_id,
+            'runner_host': new.source.runner_host,
+            'trigger': new.transition.trigger,
+            'interval_nbr': new.transition.interval_nbr,
+            'interval_type': new.transition.interval_type,
+            'job_metadata': new.source.job_metadata or '{}',
+        } for new in spawned])
+
+    def close_instances(self):
+        """ Set the running instances with all their workitems done to done"""
+        self.env.cr.execute("""SELECT i.id, count(w.id)
+                               FROM work_workflow_instance i
+                               LEFT JOIN work_workflow_workitem w ON w.instance_id = i.id AND w.state != 'done'
+                               WHERE i.state = 'running'
+                               GROUP BY i.id""")
+        instance_ids = self.engine.instances_to_close(dict(self.env.cr.fetchall()))
+        if instance_ids:
+            self.env['work.workflow.instance'].browse(instance_ids).write({'state': 'done'})
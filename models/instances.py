@@ -4,8 +4,11 @@ from odoo import models, fields, api, _, tools
 from odoo.exceptions import ValidationError
 from odoo.tools.safe_eval import safe_eval
 
-from . workflow import WORK_INTERVAL_UNITS, WORK_INTERVALS
+from . workflow import WORK_INTERVAL_UNITS, WORK_INTERVALS, WORK_PRIORITIES, DEFAULT_PRIORITY
+from . engine_adapter import EngineAdapter
+from .. engine import RUN, CHECK
 
+from collections import defaultdict
 from datetime import datetime
 import logging
 import sys
@@ -13,6 +16,26 @@ import json
 
 _logger = logging.getLogger(__name__)
 
+# Map children in these states are counted on their map workitem, see _map_join()
+MAP_COUNTERS = {
+    'done': 'map_done',
+    'exception': 'map_failed',
+    'cancelled': 'map_failed',
+}
+
+# Columns written by WorkflowWorkitem._create_bulk()
+BULK_COLUMNS = ['action_id', 'instance_id', 'workflow_id', 'parent_id', 'runner_host', 'trigger', 'interval_nbr',
+                'interval_type', 'scheduled_run', 'job_metadata', 'state', 'priority', 'job_target', 'run',
+                'triggered', 'timeout', 'pid', 'error_msg']
+BULK_BOOLEANS = ['run', 'triggered', 'timeout']
+BULK_DEFAULTS = {
+    'run': False,
+    'triggered': False,
+    'timeout': False,
+    'pid': 0,
+    'error_msg': '',
+}
+
 
 class WorkflowInstance(models.Model):
     _name = "work.workflow.instance"
@@ -89,6 +112,33 @@ class WorkflowWorkitem(models.Model):
         ('done', 'Done'),
         ], 'Status', readonly=True, copy=False, default='todo')
     error_msg = fields.Text('Error Message', readonly=True, copy=False, default='')
+    date_run = fields.Datetime('Run Date', readonly=True, copy=False)
+    date_done = fields.Datetime('Done Date', readonly=True, copy=False)
+    priority = fields.Selection(WORK_PRIORITIES, 'Priority', readonly=True, copy=False, index=True,
+                                default=DEFAULT_PRIORITY)
+    job_target = fields.Char('Job Target', readonly=True, copy=False,
+                             help="External system of the job, used by the job limits")
+    cache_key = fields.Char('Cache Key', readonly=True, copy=False)
+    # Map jobs
+    parent_id = fields.Many2one('work.workflow.workitem', 'Map Workitem', readonly=True, copy=False, index=True,
+                                ondelete='cascade')
+    child_ids = fields.One2many('work.workflow.workitem', 'parent_id', 'Map Workitems')
+    map_total = fields.Integer('Elements', readonly=True, copy=False)
+    map_spawned = fields.Integer('Spawned', readonly=True, copy=False)
+    map_done = fields.Integer('Elements Done', readonly=True, copy=False)
+    map_failed = fields.Integer('Elements Failed', readonly=True, copy=False,
+                                help="Children in exception or cancelled")
+
+    @api.model_cr
+    def init(self):
+        """ Workitems created before the priorities get the one of their action or workflow"""
+        self.env.cr.execute("""UPDATE work_workflow_workitem w
+                               SET priority = COALESCE(a.priority, f.priority, %s)
+                               FROM work_workflow_action a
+                               LEFT JOIN work_workflow f ON f.id = a.workflow_id
+                               WHERE a.id = w.action_id AND w.priority IS NULL""", (DEFAULT_PRIORITY,))
+        self.env.cr.execute("UPDATE work_workflow_workitem SET priority = %s WHERE priority IS NULL",
+                            (DEFAULT_PRIORITY,))
 
     @api.model
     def create(self, values, debug=False):
@@ -100,10 +150,24 @@ class WorkflowWorkitem(models.Model):
         :param debug: debug flag that will allow to see the stack trace
         :return:
         """
+        values = self._prepare_create_values(values)
+        workitem = super(WorkflowWorkitem, self).create(values)
+        self.env['work.workflow.stats'].record_state_change(workitem, workitem.state)
+        return workitem
+
+    @api.model
+    def _prepare_create_values(self, values, defaults=None):
+        """ Complete the values of a new workitem: scheduled run, state, the action
+        properties in *this_job*, priority and job target
+
+        :param dict values: workitem values, must contain action_id and job_metadata
+        :param dict defaults: default_get() result, to share it between several workitems
+        :return: dict of values
+        """
         # Get the defaults and calculate scheduled_run datetime
-        defaults = self.default_get(['trigger', 'interval_type', 'interval_nbr', 'job_type', 'state'])
-        defaults.update(values)
-        values = defaults
+        if defaults is None:
+            defaults = self.default_get(['trigger', 'interval_type', 'interval_nbr', 'job_type', 'state'])
+        values = dict(defaults, **values)
         create_date = datetime.now()
         trigger = values.get('trigger')
         interval_type = values.get('interval_type')
@@ -133,88 +197,119 @@ class WorkflowWorkitem(models.Model):
             values.update({
                 'job_metadata': json.dumps(job_metadata)
             })
-
-        return super(WorkflowWorkitem, self).create(values)
+            if not values.get('priority'):
+                values['priority'] = action.priority or action.workflow_id.priority
+            values['job_target'] = self.env[action.job_type].get_job_target(job_metadata)
+        return values
 
     @api.model
-    def run_job(self, debug):
+    def _create_bulk(self, values_list, chunk_size=1000):
+        """ Create many workitems with one INSERT per chunk, without the per record
+        ORM create. Values are completed like create() does.
+
+        :param list values_list: dicts with at least action_id, instance_id and job_metadata
+        :param chunk_size: max rows per INSERT
+        :return: work.workflow.workitem records
+        """
+        if not values_list:
+            return self.browse()
+        defaults = self.default_get(['trigger', 'interval_type', 'interval_nbr', 'job_type', 'state'])
+        instances = self.env['work.workflow.instance'].browse(list(set(v['instance_id'] for v in values_list)))
+        workflows = dict((inst.id, inst.workflow_id.id) for inst in instances)
+
+        rows = []
+        for values in values_list:
+            values = self._prepare_create_values(values, defaults)
+            values['workflow_id'] = workflows.get(values['instance_id'])
+            row = []
+            for column in BULK_COLUMNS:
+                value = values.get(column, BULK_DEFAULTS.get(column))
+                # Like the ORM, False is NULL unless the column is a boolean
+                row.append(None if value is False and column not in BULK_BOOLEANS else value)
+            rows.append(row + [self.env.uid, self.env.uid])
+
+        query = "INSERT INTO work_workflow_workitem (%s, create_uid, write_uid, create_date, write_date) VALUES %%s " \
+                "RETURNING id" % ', '.join(BULK_COLUMNS)
+        row_template = "(%s, %%s, %%s, (now() at time zone 'UTC'), (now() at time zone 'UTC'))" % \
+                       ', '.join(['%s'] * len(BULK_COLUMNS))
+        ids = []
+        for index in xrange(0, len(rows), chunk_size):
+            chunk = rows[index:index + chunk_size]
+            self.env.cr.execute(query % ', '.join([row_template] * len(chunk)), [value for row in chunk for value in row])
+            ids += [row[0] for row in self.env.cr.fetchall()]
+
+        return self.browse(ids)
+
+    @api.multi
+    def write(self, values):
+        """Stamps date_run/date_done and feeds the job launches and state changes to work.workflow.stats"""
+        if not values.get('run') and 'state' not in values:
+            return super(WorkflowWorkitem, self).write(values)
+
+        started = self.filtered(lambda x: not x.run) if values.get('run') else self.browse()
+        changed = self.filtered(lambda x: x.state != values['state']) if 'state' in values else self.browse()
+        previous = dict((item.id, item.state) for item in changed)
+        res = super(WorkflowWorkitem, self).write(values)
+
+        now = fields.Datetime.now()
+        if started:
+            super(WorkflowWorkitem, started).write({'date_run': now})
+            self.env['work.workflow.stats'].record_state_change(started, 'started')
+        if changed:
+            if values['state'] == 'done':
+                super(WorkflowWorkitem, changed).write({'date_done': now})
+            changed._notify_state_change(values['state'], previous)
+        return res
+
+    @api.multi
+    def _notify_state_change(self, state, previous=None):
+        """ Feed the workitems that just moved to *state* to work.workflow.stats
+        and count the finished children on their map workitem
+
+        :param dict previous: workitem id -> state before the change
+        """
+        children = self.filtered('parent_id')
+        if children:
+            children._map_join(state, previous or {})
+        self.env['work.workflow.stats'].record_state_change(self, state)
+
+    @api.multi
+    def _map_join(self, state='done', previous=None):
+        """ Move the children that reached *state* between the counters of their map
+        workitem, a child leaving a finished state (e.g. retried) is taken out of its
+        counter. The map job is over once map_done plus map_failed reaches map_total.
+
+        :param dict previous: workitem id -> state before the change
+        """
+        previous = previous or {}
+        deltas = defaultdict(lambda: defaultdict(int))
         for item in self:
-            values = item.read()[0]
-            job_metadata_json = values.get('job_metadata', '{}')
-
-            # Check if job metadata can be parsed as json
-            try:
-                job_metadata = json.loads(job_metadata_json)
-            except TypeError:
-                raise ValidationError(_("Input parameters are wrong. %s"))
-
-            # Job values for explicitly
-            job_values = {
-                'job_metadata': job_metadata,
-                'scheduled_run': item.scheduled_run,
-                'run': item.run,
-                'triggered': item.run,
-                'timeout': item.run,
-                'pid': item.run,
-                'state': item.run,
-                'error_msg': item.error_msg
-            }
+            old_counter = MAP_COUNTERS.get(previous.get(item.id))
+            new_counter = MAP_COUNTERS.get(state)
+            if old_counter == new_counter:
+                continue
+            if old_counter:
+                deltas[item.parent_id.id][old_counter] -= 1
+            if new_counter:
+                deltas[item.parent_id.id][new_counter] += 1
+        for parent_id, counters in deltas.items():
+            self.env.cr.execute("UPDATE work_workflow_workitem SET %s WHERE id = %%s" % ', '.join(
+                '%s = %s + %%s' % (counter, counter) for counter in counters),
+                counters.values() + [parent_id])
+        self.invalidate_cache(['map_done', 'map_failed'], list(deltas))
 
-            values = self._run_job(job_values, item.job_type, debug)
-
-            item.job_metadata = json.dumps(values.get('job_metadata', '{}'))
-            item.scheduled_run = values.get('scheduled_run', item.create_date)
-            item.run = values.get('run', False)
-            item.triggered = values.get('triggered', False)
-            item.timeout = values.get('timeout', 0)
-            item.pid = values.get('pid', 0)
-            item.state = values.get('state', 'todo')
-            item.error_msg = values.get('error_msg', '')
-
-    def _run_job(self, values, job_type, debug=False):
-        now = datetime.now()
-
-        scheduled_run = values['scheduled_run']
-
-        if job_type.startswith('work.workflow.job.'):
-            res = {}
-            scheduled_run = datetime.strptime(scheduled_run, tools.DEFAULT_SERVER_DATETIME_FORMAT)
-            if scheduled_run >= now:
-                # Debug for development mode
-                if debug:
-                    values = self.env[job_type].run_job(values)
-                else:
-                    try:
-                        values = self.env[job_type].run_job(values)
-                    except:
-                        e = sys.exc_info()[0]
-                        values['error_msg'] = e
-                values['job_metadata'] = json.dumps(values.get('job_metadata', ''))
-        return values
+    @api.multi
+    def run_job(self, debug=False):
+        """ Launch the jobs of the workitems that are due, see EngineAdapter.process()"""
+        adapter = EngineAdapter(self.env)
+        adapter.process(adapter.load_workitems(self.ids), debug=debug, steps=(RUN,))
+        return True
 
-    @api.model
+    @api.multi
     def check_job(self, debug=False):
-        for item in self:
-            values = item.read()[0]
-            values.update({
-                'job_metadata': safe_eval(unicode(json.loads(values.get('job_metadata', '{}'))))
-            })
-            job_type = item.job_type
-            if job_type.startswith('work.workflow.job.'):
-                res = {}
-                # Debug for development mode
-                if debug:
-                    res = item.env[job_type].check_job(values)
-                else:
-                    try:
-                        res = item.env[job_type].check_job(values)
-                    except:
-                        e = sys.exc_info()[0]
-                        item.error_msg = e
-
-            item.job_metadata = json.dumps(values.get('job_metadata', ''))
-            if 'state' in res:
-                item.state = res['state']
+        """ Poll the launched jobs of the workitems, see EngineAdapter.process()"""
+        adapter = EngineAdapter(self.env)
+        adapter.process(adapter.load_workitems(self.ids), debug=debug, steps=(CHECK,))
         return True
 
     def _compute_name(self):
@@ -235,31 +330,11 @@ class WorkflowWorkitem(models.Model):
         else:
             self.scheduled_run = self.create_date
 
-    @api.model
+    @api.multi
     def run_transitions(self, debug=False):
-        job_id = self.id
-        _logger.info("---- run transitions job_id %d", job_id)
-        transitions_not_done = self.action_id.to_ids.filtered(lambda x: x.id not in self.completed_ids.ids)
-        if len(transitions_not_done) == 0:
-            self.triggered = True
-        else:
-            for transition in transitions_not_done:
-                condition = transition.condition
-
-                eval_context = {
-                    'metadata': safe_eval(unicode(json.loads(self.job_metadata))),
-                    'workitem': self,
-                }
-                if safe_eval(condition, eval_context):
-                    new_wk_item = self.copy({
-                        'action_id': transition.action_to_id.id,
-                        'trigger': transition.trigger,
-                        'interval_nbr': transition.interval_nbr,
-                        'interval_type': transition.interval_type,
-                        'job_type': transition.action_to_id.job_type,
-                        'triggered': False,
-                        'run': False,
-                    })
-
-            # Mark all transitions as completed
-            self.completed_ids = [(6, 0,  transitions_not_done.ids)]
+        """ Fire the transitions of the done workitems, see EngineAdapter.run_transitions()
+
+        :return: created workitems
+        """
+        _logger.info("---- run transitions job_ids %s", self.ids)
+        return EngineAdapter(self.env).run_transitions(self.ids)
@@ -2,14 +2,24 @@
 
 from odoo import models, fields, api, _, tools
 from odoo.exceptions import ValidationError
+
+from . backends import register_job_type, lazy_import
+
 import os
 import time
+import json
 import logging
-import jenkins
+
+jenkins = lazy_import('jenkins', 'python-jenkins')
 
 
 _logger = logging.getLogger(__name__)
 
+register_job_type('work.workflow.job.router', 'Router')
+register_job_type('work.workflow.job.jenkins', 'Jenkins Job')
+register_job_type('work.workflow.job.draft', 'Draft Job')
+register_job_type('work.workflow.job.map', 'Map')
+
 
 class WorkflowJobRouter(models.Model):
     _name = 'work.workflow.job.router'
@@ -53,6 +63,16 @@ class WorkflowJobJenkins(models.Model):
         jenkins_password = params.sudo().get_param('jenkins_ci.password', default='')
         return jenkins_url, jenkins_user, jenkins_password
 
+    @api.model
+    def get_job_target(self, job_metadata):
+        return self.env['ir.config_parameter'].sudo().get_param('jenkins_ci.url', default=False)
+
+    @api.model
+    def get_cache_key(self, job_metadata):
+        # Same job with the same inputs, the build number of a previous run doesn't matter
+        inputs = dict((key, value) for key, value in job_metadata.items() if key not in ('instance_id', 'this_job'))
+        return {'job_name': job_metadata.get('this_job', {}).get('job_name'), 'inputs': inputs}
+
     def jenkins_build_job(self, job):
         jenkins_url, jenkins_user, jenkins_password = self.get_vars()
         server = jenkins.Jenkins(jenkins_url, username=jenkins_user, password=jenkins_password)
@@ -106,7 +126,7 @@ class WorkflowJobDraft(models.Model):
 
     @api.model
     def run_job(self, values):
-        item = super(WorkflowJobRouter, self).run_job(values)
+        item = super(WorkflowJobDraft, self).run_job(values)
 
         _logger.info('--- draft job is running')
         item.update({'run': True})
@@ -115,7 +135,7 @@ class WorkflowJobDraft(models.Model):
 
     @api.model
     def check_job(self, values):
-        item = super(WorkflowJobRouter, self).check_job(values)
+        item = super(WorkflowJobDraft, self).check_job(values)
 
         _logger.info('--- draft job is done')
         values.update({'state': 'done'})
@@ -123,11 +143,109 @@ class WorkflowJobDraft(models.Model):
         return item
 
 
-class WorkflowProcess(models.Model):
-    _inherit = "work.workflow.action"
+class WorkflowJobMap(models.Model):
+    """Fan-out job: runs the *Map Action* once for each element of the
+    metadata list named by *list_key*. The children are created in chunks,
+    at most *parallelism* running at once (0 for no limit), and the map
+    workitem is over once all of them are done, in exception or cancelled,
+    which is tracked by counting the finished children instead of scanning
+    them. The map workitem goes to exception if any child failed.
+
+    Each child gets the map metadata without the list, plus the element under
+    *item_key* and its position under *map_index*.
+    """
+    _name = 'work.workflow.job.map'
+    _inherit = 'work.workflow.job'
+
+    @staticmethod
+    def get_properties_defaults():
+        return '{"list_key": "items", "item_key": "item", "parallelism": 0, "chunk_size": 500}'
+
+    @staticmethod
+    def map_elements(job_metadata):
+        """ The list to map over
+
+        :param dict job_metadata: metadata of the map workitem
+        :return: list of elements
+        """
+        return job_metadata.get(job_metadata.get('this_job', {}).get('list_key', 'items')) or []
+
+    @api.model
+    def map_spawn(self, workitem, job_metadata):
+        """ Create the next children of the map workitem
+
+        The map workitem row is locked first so two managers never spawn the
+        same elements, a map locked by another transaction is left for a
+        later tick.
+
+        :param workitem: map work.workflow.workitem record
+        :param dict job_metadata: metadata of the map workitem
+        :return: created work.workflow.workitem records
+        """
+        this_job = job_metadata.get('this_job', {})
+        list_key = this_job.get('list_key', 'items')
+        item_key = this_job.get('item_key', 'item')
+        parallelism = this_job.get('parallelism', 0)
+        elements = self.map_elements(job_metadata)
+
+        self.env.cr.execute("""SELECT map_spawned, map_done + map_failed FROM work_workflow_workitem
+                               WHERE id = %s FOR UPDATE SKIP LOCKED""", (workitem.id,))
+        row = self.env.cr.fetchone()
+        if not row:
+            return self.env['work.workflow.workitem']
+        spawned, finished = row
+
+        count = len(elements) - spawned
+        if parallelism:
+            count = min(count, parallelism - (spawned - finished))
+        if count <= 0:
+            return self.env['work.workflow.workitem']
+
+        base_metadata = dict((key, value) for key, value in job_metadata.items() if key not in ('this_job', list_key))
+        values_list = []
+        for index in xrange(spawned, spawned + count):
+            metadata = dict(base_metadata)
+            metadata.update({item_key: elements[index], 'map_index': index})
+            values_list.append({
+                'action_id': workitem.action_id.map_action_id.id,
+                'instance_id': workitem.instance_id.id,
+                'parent_id': workitem.id,
+                'runner_host': workitem.runner_host,
+                'job_metadata': json.dumps(metadata),
+            })
+        children = self.env['work.workflow.workitem']._create_bulk(values_list, this_job.get('chunk_size', 500))
+        workitem.write({'map_total': len(elements), 'map_spawned': spawned + count})
+        return children
+
+    @api.model
+    def run_job(self, values):
+        values = super(WorkflowJobMap, self).run_job(values)
+        workitem = self.env['work.workflow.workitem'].browse(values['id'])
+        if not workitem.action_id.map_action_id:
+            raise ValidationError(_('Map action %s has no action to run for each element') % workitem.action_id.name)
+
+        children = self.map_spawn(workitem, values['job_metadata'])
+        _logger.info('--- map job spawned %d workitems', len(children))
+        values.update({'run': True, 'state': 'running'})
+
+        return values
+
+    @api.model
+    def check_job(self, values):
+        values = super(WorkflowJobMap, self).check_job(values)
+        workitem = self.env['work.workflow.workitem'].browse(values['id'])
+        self.map_spawn(workitem, values['job_metadata'])
+        total = len(self.map_elements(values['job_metadata']))
+        if workitem.map_done + workitem.map_failed < total:
+            return values
+        if workitem.map_failed:
+            _logger.info('--- map job failed')
+            values.update({
+                'state': 'exception',
+                'error_msg': _('%d of %d elements failed') % (workitem.map_failed, total),
+            })
+        else:
+            _logger.info('--- map job is done')
+            values.update({'state': 'done'})
 
-    job_type = fields.Selection(
-        selection_add=[
-            ('work.workflow.job.jenkins', 'Jenkins Job'),
-            ('work.workflow.job.draft', 'Draft Job')
-        ])
+        return values
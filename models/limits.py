@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, _, tools
+
+from collections import defaultdict
+import logging
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+UNLIMITED = float('inf')
+
+
+class JobLimiter(object):
+    """Launch capacity of the limited job types for one manager tick
+
+    Capacities are keyed by (job_type, target), target False holds the limit
+    of the whole job type. Job types without a limit are not restricted.
+    """
+
+    def __init__(self, capacity, limit_ids=(), refill_date=0.0):
+        self.capacity = capacity
+        self.limit_ids = list(limit_ids)
+        self.refill_date = refill_date
+        self.used = defaultdict(int)
+
+    def _keys(self, job_type, target=False):
+        keys = [(job_type, False)]
+        if target:
+            keys.append((job_type, target))
+        return [key for key in keys if key in self.capacity]
+
+    def acquire(self, job_type, target=False):
+        """ Take one launch slot for the job type and target
+
+        :return: True if the workitem can be launched now
+        """
+        keys = self._keys(job_type, target)
+        if any(self.capacity[key] < 1 for key in keys):
+            return False
+        for key in keys:
+            self.capacity[key] -= 1
+            self.used[key] += 1
+        return True
+
+    def caps(self):
+        """ Launch capacities that are limited on this tick
+
+        :return: dict (job_type, target) -> int, target False for the whole job type
+        """
+        return dict((key, int(capacity)) for key, capacity in self.capacity.items() if capacity != UNLIMITED)
+
+    def saturated(self):
+        """ Job types and targets that cannot launch anything on this tick
+
+        :return: list of (job_type, target), target False for the whole job type
+        """
+        return [key for key, capacity in self.capacity.items() if capacity < 1]
+
+
+class WorkflowJobLimit(models.Model):
+    """Concurrency cap and token bucket rate limit per job type and optionally per target"""
+    _name = 'work.workflow.job.limit'
+    _description = "Workflow Job Limit"
+    _order = 'job_type, target'
+    _rec_name = 'job_type'
+
+    job_type = fields.Selection(selection=lambda self: self.env['work.workflow.action']._get_job_types(),
+                                string='Job', required=True)
+    target = fields.Char('Target', help="External system the limit applies to (e.g. the Jenkins url), "
+                                        "leave empty to limit the whole job type")
+    max_running = fields.Integer('Max Running', default=0,
+                                 help="Max number of workitems of this job type running at once, 0 for no limit")
+    rate = fields.Float('Rate (per minute)', default=0.0,
+                        help="Number of workitems of this job type that can be launched per minute, 0 for no limit")
+    burst = fields.Integer('Burst', default=1, help="Number of launches that can be saved up while idle")
+    tokens = fields.Float('Available Launches', readonly=True, copy=False, default=0.0)
+    last_refill = fields.Float('Last Refill', readonly=True, copy=False, default=0.0)
+    active = fields.Boolean('Active', default=True)
+
+    _sql_constraints = [
+        ('job_type_target_unique', 'UNIQUE(job_type, target)', 'Only one limit per job type and target'),
+        ('max_running_positive', 'CHECK(max_running >= 0)', 'Max running must be positive or zero'),
+        ('rate_positive', 'CHECK(rate >= 0)', 'The rate must be positive or zero'),
+        ('burst_positive', 'CHECK(burst >= 1)', 'The burst must be at least 1'),
+    ]
+
+    @api.model
+    def get_limiter(self):
+        """ Lock the limits and compute the launch capacity of this tick
+
+        The limit rows stay locked until the manager transaction ends, so the
+        tokens and running counts are consistent across all the managers.
+        Limits locked by another manager are skipped with a capacity of 0,
+        their workitems just wait for a later tick.
+
+        :return: JobLimiter
+        """
+        self.env.cr.execute("""SELECT id FROM work_workflow_job_limit WHERE active
+                               FOR UPDATE SKIP LOCKED""")
+        locked_ids = set(row[0] for row in self.env.cr.fetchall())
+        limits = self.search([])
+        if not limits:
+            return JobLimiter({})
+
+        self.env.cr.execute("""SELECT a.job_type, w.job_target, count(*)
+                               FROM work_workflow_workitem w
+                               JOIN work_workflow_action a ON a.id = w.action_id
+                               WHERE w.state = 'running' AND w.run AND a.job_type IN %s
+                               GROUP BY a.job_type, w.job_target""", (tuple(set(limits.mapped('job_type'))),))
+        running = defaultdict(int)
+        for job_type, target, count in self.env.cr.fetchall():
+            running[(job_type, False)] += count
+            if target:
+                running[(job_type, target)] += count
+
+        now = time.time()
+        capacity = {}
+        for limit in limits:
+            key = (limit.job_type, limit.target or False)
+            if limit.id not in locked_ids:
+                capacity[key] = 0
+                continue
+            slots = UNLIMITED
+            if limit.max_running:
+                slots = max(limit.max_running - running[key], 0)
+            if limit.rate:
+                tokens = limit._refill(now)
+                slots = min(slots, int(tokens))
+            capacity[key] = slots
+        return JobLimiter(capacity, locked_ids, now)
+
+    @api.multi
+    def _refill(self, now):
+        self.ensure_one()
+        if not self.last_refill:
+            return float(self.burst)
+        return min(float(self.burst), self.tokens + (now - self.last_refill) * self.rate / 60.0)
+
+    @api.model
+    def consume(self, limiter):
+        """ Store the tokens left once the tick has launched its workitems
+
+        :param limiter: JobLimiter returned by get_limiter()
+        """
+        for limit in self.browse(limiter.limit_ids):
+            if not limit.rate:
+                continue
+            used = limiter.used[(limit.job_type, limit.target or False)]
+            limit.write({
+                'tokens': max(limit._refill(limiter.refill_date) - used, 0.0),
+                'last_refill': limiter.refill_date,
+            })
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, _, tools
+
+from collections import defaultdict
+from contextlib import contextmanager
+import base64
+import logging
+import sys
+import threading
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+PROFILE_PHASES = [
+    ('limits', 'Job Limits'),
+    ('search', 'Search'),
+    ('run_job', 'Run Job'),
+    ('check_job', 'Check Job'),
+    ('persist', 'Persist Results'),
+    ('run_transitions', 'Run Transitions'),
+    ('close_instances', 'Close Instances'),
+]
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class NullProfiler(object):
+    """Used by the job manager when profiling is off, every call is a no-op
+    so the tick does not pay for the instrumentation
+    """
+    enabled = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def phase(self, phase, job_type=False):
+        return _NULL_PHASE
+
+
+class TickProfiler(object):
+    """Profiles a single tick of the job manager
+
+    * SQL queries are counted and timed by wrapping the cursor *execute* and
+      are attributed to the current (job_type, phase)
+    * A sampling thread takes the stack of the profiled thread every
+      *interval* seconds and keeps it in the folded format of flamegraph.pl
+
+    """
+    enabled = True
+
+    def __init__(self, cr, interval=0.005):
+        self.cr = cr
+        self.interval = interval
+        self.current = (False, 'search')
+        self.stats = defaultdict(lambda: {'items': 0, 'duration': 0.0, 'query_count': 0, 'query_duration': 0.0})
+        self.samples = defaultdict(int)
+        self.date_start = False
+        self.duration = 0.0
+        self._start = 0.0
+        self._base_depth = 0
+        self._thread_id = None
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self.date_start = fields.Datetime.now()
+        self._thread_id = threading.current_thread().ident
+        # Only keep the frames from the caller (the manager tick) downwards
+        self._base_depth = len(self._frames(sys._getframe(1))) - 1
+
+        execute = self.cr.execute
+
+        def profiled_execute(*args, **kwargs):
+            start = time.time()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                stat = self.stats[self.current]
+                stat['query_count'] += 1
+                stat['query_duration'] += time.time() - start
+        self.cr.execute = profiled_execute
+
+        self._sampler = threading.Thread(target=self._sample, name='work.workflow.profiler')
+        self._sampler.daemon = True
+        self._start = time.time()
+        self._sampler.start()
+
+    def stop(self):
+        self.duration = time.time() - self._start
+        self._stopped.set()
+        self._sampler.join()
+        del self.cr.execute
+
+    @contextmanager
+    def phase(self, phase, job_type=False):
+        previous = self.current
+        self.current = (job_type, phase)
+        start = time.time()
+        try:
+            yield
+        finally:
+            stat = self.stats[self.current]
+            stat['items'] += 1
+            stat['duration'] += time.time() - start
+            self.current = previous
+
+    @staticmethod
+    def _frames(frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append('%s.%s' % (frame.f_globals.get('__name__', '?'), code.co_name))
+            frame = frame.f_back
+        frames.reverse()
+        return frames
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            job_type, phase = self.current
+            stack = ['%s[%s]' % (phase, job_type or '-')] + self._frames(frame)[self._base_depth:]
+            self.samples[';'.join(stack)] += 1
+            del frame
+
+    def folded(self):
+        """ Stacks in the collapsed format read by flamegraph.pl and speedscope
+
+        :return: string with one "frame;frame;frame count" per line
+        """
+        return '\n'.join('%s %d' % (stack, count) for stack, count in sorted(self.samples.items()))
+
+
+class WorkflowProfile(models.Model):
+    _name = 'work.workflow.profile'
+    _description = "Workflow Manager Profile"
+    _order = 'id desc'
+
+    name = fields.Char('Name', required=True, readonly=True)
+    host = fields.Char('Host', readonly=True)
+    date_start = fields.Datetime('Started', readonly=True)
+    duration = fields.Float('Duration (s)', digits=(16, 4), readonly=True)
+    query_count = fields.Integer('Queries', readonly=True)
+    query_duration = fields.Float('Query Time (s)', digits=(16, 4), readonly=True)
+    sample_count = fields.Integer('Samples', readonly=True)
+    flamegraph = fields.Binary('Flamegraph', attachment=True, readonly=True,
+                               help="Folded stacks, render with flamegraph.pl or speedscope")
+    flamegraph_filename = fields.Char('Flamegraph Filename', readonly=True)
+    line_ids = fields.One2many('work.workflow.profile.line', 'profile_id', 'Phases', readonly=True)
+
+    @api.model
+    def create_from_profiler(self, profiler, host):
+        """ Store the summary and the flamegraph of a finished TickProfiler
+
+        :param profiler: stopped TickProfiler
+        :param host: host the manager tick ran for
+        :return: work.workflow.profile record
+        """
+        lines = []
+        for (job_type, phase), stat in sorted(profiler.stats.items()):
+            lines.append((0, 0, {
+                'job_type': job_type or False,
+                'phase': phase,
+                'items': stat['items'],
+                'duration': stat['duration'],
+                'query_count': stat['query_count'],
+                'query_duration': stat['query_duration'],
+            }))
+        name = 'TICK %s - %s' % (profiler.date_start, host)
+        profile = self.sudo().create({
+            'name': name,
+            'host': host,
+            'date_start': profiler.date_start,
+            'duration': profiler.duration,
+            'query_count': sum(stat['query_count'] for stat in profiler.stats.values()),
+            'query_duration': sum(stat['query_duration'] for stat in profiler.stats.values()),
+            'sample_count': sum(profiler.samples.values()),
+            'flamegraph': base64.b64encode(profiler.folded()),
+            'flamegraph_filename': '%s.folded' % name.replace(' ', '_').replace(':', ''),
+            'line_ids': lines,
+        })
+        _logger.info('WKF: Manager tick profiled in %s', profile.name)
+        return profile
+
+
+class WorkflowProfileLine(models.Model):
+    _name = 'work.workflow.profile.line'
+    _description = "Workflow Manager Profile Line"
+    _order = 'duration desc'
+
+    profile_id = fields.Many2one('work.workflow.profile', 'Profile', required=True, ondelete='cascade', index=True)
+    job_type = fields.Char('Job Type')
+    phase = fields.Selection(PROFILE_PHASES, 'Phase', required=True)
+    items = fields.Integer('Items')
+    duration = fields.Float('Duration (s)', digits=(16, 4))
+    query_count = fields.Integer('Queries')
+    query_duration = fields.Float('Query Time (s)', digits=(16, 4))
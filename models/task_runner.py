@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from odoo import models, fields, api, _, tools
+
+from . engine_adapter import EngineAdapter
+from . profiling import NullProfiler, TickProfiler
+
 import uuid
 
 import logging
@@ -8,6 +12,9 @@ import logging
 
 _logger = logging.getLogger(__name__)
 
+# Default number of workitems a manager tick runs or checks, see work.manager_budget
+DEFAULT_BUDGET = 1000
+
 
 class WorkflowJobManager(models.TransientModel):
     """This is the inbuilt Task Runner Client
@@ -26,7 +33,27 @@ class WorkflowJobManager(models.TransientModel):
     # _auto = False
 
     @api.model
-    def manage_jobs(self, host, debug=False,):
+    def _get_profiler(self, profile=False):
+        """ Profiling is enabled by the *profile* flag, the context key *work_profile* or
+        the config parameter *work.manager_profile*. The config parameter only arms the
+        next tick and is cleared once read.
+        """
+        if not profile and not self.env.context.get('work_profile'):
+            params = self.env['ir.config_parameter'].sudo()
+            if params.get_param('work.manager_profile', default='0') in ('0', 'False', 'false', ''):
+                return NullProfiler()
+            params.set_param('work.manager_profile', '0')
+        return TickProfiler(self.env.cr)
+
+    @api.model
+    def _get_budget(self, budget=None):
+        if budget is None:
+            params = self.env['ir.config_parameter'].sudo()
+            budget = int(params.get_param('work.manager_budget', default=DEFAULT_BUDGET))
+        return budget
+
+    @api.model
+    def manage_jobs(self, host, debug=False, profile=False, budget=None):
         """ Workflow Job Manager will check workitems and will trigger transitions to create new workitems
 
         This method will not start any workflow, it will only maintain the existing workitem flow.
@@ -42,42 +69,51 @@ class WorkflowJobManager(models.TransientModel):
             * Trigger transactions - completed, not triggered
             * Close completed instances
 
+        Each tick runs, checks or fires the transitions of at most *budget* workitems
+        (config parameter *work.manager_budget*, 0 for no limit), fairly shared
+        between workflows. Transitions get what the jobs left of the budget.
+        When profiling, the tick is stored as a work.workflow.profile record
+
         """
+        profiler = self._get_profiler(profile)
+        profiler.start()
+        try:
+            self._manage_jobs(host, profiler, debug=debug, budget=self._get_budget(budget))
+        finally:
+            profiler.stop()
+        if profiler.enabled:
+            self.env['work.workflow.profile'].create_from_profiler(profiler, host)
 
-        # This client might not be capable of doing all type of jobs
-        # this is why we need a selector
-        job_type_selector = 'work.workflow.job'
-
-        # Check jobs - active ones: not done or cancel
-        workitems_to_check = self.env['work.workflow.workitem'].search([
-            ('job_type', 'ilike', job_type_selector),
-            ('state', 'not in', ['done', 'canceled'])
-        ])
-        print "------------- manage", workitems_to_check
-
-        for wk in workitems_to_check:
-            # Run the postponed jobs
-            if wk.state == 'running' and not wk.run:
-                wk.run_job(debug=debug)
-            # Else if job is run then just check it
-            elif wk.state == 'running' and wk.run:
-                wk.check_job(debug=debug)
-
-        # Trigger transactions - completed, not triggered
-        workitems_to_trigger = self.env['work.workflow.workitem'].search([
-            ('state', '=', 'done'),
-            ('triggered', '=', False),
-        ])
-        for wk in workitems_to_trigger:
-            wk.run_transitions(debug=debug)
+    @api.model
+    def _manage_jobs(self, host, profiler, debug=False, budget=0):
+        # Job types at their concurrency or rate limit don't launch anything,
+        # their workitems stay queued until a later tick
+        with profiler.phase('limits'):
+            limiter = self.env['work.workflow.job.limit'].get_limiter()
+
+        # Check jobs - active ones: only running ones can be run or checked,
+        # the results are written back in bulk once all the jobs were called
+        adapter = EngineAdapter(self.env)
+        with profiler.phase('search'):
+            items = adapter.schedule(budget, limiter)
+        _logger.debug('WKF: Manager tick for %s takes %d workitems', host, len(items))
+        adapter.process(items, limiter, profiler, debug=debug)
+        with profiler.phase('limits'):
+            self.env['work.workflow.job.limit'].consume(limiter)
+
+        # Trigger transactions - completed, not triggered, with what is left of the budget
+        remaining = max(budget - len(items), 0) if budget else None
+        triggerable = {}
+        if remaining is None or remaining:
+            with profiler.phase('search'):
+                triggerable = adapter.triggerable(remaining)
+        for job_type, workitem_ids in triggerable.items():
+            with profiler.phase('run_transitions', job_type):
+                adapter.run_transitions(workitem_ids)
 
         # Close completed instances
-        running_instances = self.env['work.workflow.instance'].search([
-            ('state', 'not in', ['done', 'canceled'])
-        ])
-        for inst in running_instances:
-            if len(inst.workitem_ids.filtered(lambda x: x.state != 'done')) == 0:
-                inst.state = 'done'
+        with profiler.phase('close_instances'):
+            adapter.close_instances()
 
 
 class Workflow(models.Model):
@@ -3,6 +3,8 @@
 from odoo import models, fields, api, _, tools
 from odoo.exceptions import ValidationError
 
+from . backends import get_job_types
+
 from exceptions import TypeError
 from dateutil.relativedelta import relativedelta
 import json
@@ -27,6 +29,22 @@ WORK_INTERVALS = {
     'years': lambda interval: relativedelta(years=interval),
 }
 
+WORK_PRIORITIES = [
+    ('0', 'Low'),
+    ('1', 'Normal'),
+    ('2', 'High'),
+    ('3', 'Urgent'),
+]
+DEFAULT_PRIORITY = '1'
+
+# Multiplier applied to the workflow weight when splitting the manager budget
+WORK_PRIORITY_WEIGHTS = {
+    '0': 1,
+    '1': 2,
+    '2': 4,
+    '3': 8,
+}
+
 
 class WorkflowJob(models.AbstractModel):
     """ A mixin for models that implements workflow job
@@ -43,7 +61,8 @@ class WorkflowJob(models.AbstractModel):
 
     @api.model
     def run_job(self, values):
-        """ Extend this method to add run action. First,
+        """ Extend this method to add run action, *values* and the returned dict are plain
+        values (see Workitem.job_values() in engine/core.py), the manager writes them back. First,
         Always check if *run* is False and *state* is running else don't run since check_job() will take care
 
         :param dict values: workitem new values:
@@ -53,7 +72,7 @@ class WorkflowJob(models.AbstractModel):
 
         :return: dict with of the process if there is one and other vars
         """
-        raise NotImplementedError("Should have implemented this")
+        return values
 
     @api.model
     def check_job(self, values):
@@ -67,7 +86,28 @@ class WorkflowJob(models.AbstractModel):
         :return: dict with full workitem record.
                  update changes to job_output
         """
-        raise NotImplementedError("Should have implemented this")
+        return values
+
+    @api.model
+    def get_job_target(self, job_metadata):
+        """ Extend this method to name the external system the job talks to,
+        work.workflow.job.limit can cap the workitems running per target.
+
+        :param dict job_metadata: workitem metadata, with the action properties in *this_job*
+        :return: string or False
+        """
+        return False
+
+    @api.model
+    def get_cache_key(self, job_metadata):
+        """ Extend this method to make the job cacheable. Return the part of the metadata
+        that decides the result of the job, workitems of an action with a cache TTL and the
+        same key are completed with the cached result without running the job.
+
+        :param dict job_metadata: workitem metadata, with the action properties in *this_job*
+        :return: json serializable value or None if the job can't be cached
+        """
+        return None
 
 
 class Workflow(models.Model):
@@ -87,6 +127,14 @@ class Workflow(models.Model):
     instance_ids = fields.One2many('work.workflow.instance', 'workflow_id', 'Instances')
     instance_ids_count = fields.Integer(compute='_instance_ids_count')
     start_metadata = fields.Text('Job Metadata', copy=True, default="{}")
+    priority = fields.Selection(WORK_PRIORITIES, 'Priority', required=True, default=DEFAULT_PRIORITY,
+                                help="Default priority of the workitems of this workflow")
+    weight = fields.Integer('Weight', required=True, default=1,
+                            help="Share of the manager budget given to this workflow on each tick")
+
+    _sql_constraints = [
+        ('weight_positive', 'CHECK(weight > 0)', 'The weight must be positive')
+    ]
 
     @api.multi
     @api.depends('workitem_ids')
@@ -184,16 +232,30 @@ class WorkflowAction(models.Model):
     properties = fields.Text('Action Properties', required=False, default='{}')
     workflow_id = fields.Many2one('work.workflow', 'Workflow', required=True, ondelete='cascade', index=True)
     start = fields.Boolean('Start', help="This action is launched when the workflow starts.", index=True)
-    job_type = fields.Selection(selection=[('work.workflow.job.router', 'Router')], string='Job', required=True)
+    job_type = fields.Selection(selection=lambda self: self.env['work.workflow.action']._get_job_types(),
+                                string='Job', required=True)
     to_ids = fields.One2many('work.workflow.transition', 'action_from_id', 'Next Action')
     from_ids = fields.One2many('work.workflow.transition', 'action_to_id', 'Previous Actions')
     timeout = fields.Integer('Default Timeout(s)', help='Default timeout in seconds if 0 then there is no timeout', default=0)
+    priority = fields.Selection(WORK_PRIORITIES, 'Priority',
+                                help="Priority of the workitems of this action, the workflow priority if empty")
+    cache_ttl = fields.Integer('Cache TTL(s)', default=0,
+                               help="Seconds the result of a cacheable job is reused for the same inputs, "
+                                    "if 0 then results are not cached")
+    cache_size = fields.Integer('Cache Size', default=100, help="Max number of cached results of this action")
+    map_action_id = fields.Many2one('work.workflow.action', 'Map Action', ondelete='restrict',
+                                    help="Action run for each element of the list of a map job")
     state = fields.Selection([
         ('draft', 'New'),
         ('active', 'Active'),
         ('disabled', 'Disabled')
         ], 'Status', copy=False, default="draft")
 
+    @api.model
+    def _get_job_types(self):
+        # Job types of addons that are not installed in this database are left out
+        return [(model, label) for model, label in get_job_types() if model in self.env]
+
     @api.model
     def default_get(self, fields):
         result = super(WorkflowAction, self).default_get(fields)